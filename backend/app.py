@@ -1,22 +1,53 @@
 from fastapi import FastAPI, HTTPException, Body, Depends, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Final
 import os
 import sys
 import pyodbc
+import re
 import json
+import asyncio
 import time
+import hashlib
+import orjson
+from decimal import Decimal
 import logging
 from dotenv import load_dotenv
-import openai
+import httpx
+from openai import AsyncOpenAI
 from schema_extractor import SchemaExtractor
 import sql_validator
+import db
+from response_cache import ResponseCache, extract_literals
+
+# gpt-4o-mini supports OpenAI's automatic prompt caching for the >1024 token schema prefix
+OPENAI_MODEL = os.getenv("OAI_MODEL", "gpt-4o-mini")
+OPENAI_TEMPERATURE = 0.2  # Lower temperature for more deterministic outputs
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Serve near-identical questions from the semantic cache tier; set SEMANTIC_CACHE=false to only reuse exact matches
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "true").lower() == "true"
+FETCH_BATCH_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+# SQLSTATEs for communication link failures, deadlocks and timeouts
+TRANSIENT_SQLSTATES = frozenset({"08S01", "40001", "HYT00"})
+RETRY_BACKOFF_SECONDS = 0.2
+
+# Matches the "SQL: ... Explanation: ..." format the prompts ask the model for;
+# "SQL:" must start a line, so a preamble like "Here is the T-SQL:" isn't captured
+RESPONSE_RE = re.compile(
+    r"^SQL:\s*(?P<sql>.*?)\s*(?:Explanation:\s*(?P<explanation>.*))?\Z",
+    re.DOTALL | re.MULTILINE
+)
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Text-to-SQL API",
     description="API for converting natural language to SQL queries",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # Much faster than the stdlib encoder on large result sets
 )
 app.state.db_metadata = sql_validator.refresh_schemas_and_columns()
 
@@ -42,18 +73,20 @@ def check_openai_api_key():
         logging.error("Error: OpenAI API key is not set.")
         logging.error("Please set the environment variable 'OPENAI_API_KEY' with your OpenAI API key.")
         sys.exit()
-    # Set your OpenAI API key
-    openai.api_key = os.environ["OPENAI_API_KEY"]
 
 check_openai_api_key()
 
 
 
 # Add CORS middleware
+# ALLOWED_ORIGINS is a comma-separated list, e.g. "http://localhost,http://localhost:3000".
+# A fixed list lets Starlette match origins statically; with the "*" wildcard credentials are
+# disabled so the middleware doesn't have to reflect each request's Origin header.
+ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",") if origin.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # For production, replace with specific origins
-    allow_credentials=True,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials="*" not in ALLOWED_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -83,55 +116,70 @@ class ExecutionResponse(BaseModel):
     error: Optional[str] = None
     retry_count: Optional[int] = None
 
-# Database connection
-def get_db_connection():
-    """Create and return a database connection"""
-    try:
-        connection_string = (f"""
-    DRIVER={{ODBC Driver 17 for SQL Server}};
-    SERVER={os.getenv('DB_SERVER')};
-    DATABASE={os.getenv('DB_NAME')};
-    UID={os.getenv('DB_USER')};
-    PWD={os.getenv('DB_PASSWORD')};
-"""
-        )
-        return pyodbc.connect(connection_string)
-    except Exception as e:
-        logger.error(f"Error connecting to database: {e}")
-        raise HTTPException(status_code=500, detail=f"Database connection error: {str(e)}")
-
 # Load schema information
 @app.on_event("startup")
 async def startup_event():
+    # OpenAI client reusing keep-alive HTTP/2 connections across requests
+    app.state.oai = AsyncOpenAI(
+        api_key=os.environ["OPENAI_API_KEY"],
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+        )
+    )
+    
+    # Share the connection string with everything that connects
+    app.state.conn_str = db.CONNECTION_STRING
+    
+    try:
+        # Shared pool of database connections for executing queries
+        await db.create_pool(app.state.conn_str)
+    except Exception as e:
+        # Requests retry creating it once the database is reachable
+        logger.error(f"Error creating database connection pool: {e}")
+    
     try:
-        # Check if schema file exists
+        # Schema extraction and file I/O block, so keep them off the event loop
         schema_file = "adventure_works_schema.json"
-        if not os.path.exists(schema_file):
-            logger.info("Schema file not found. Extracting schema...")
-            extractor = SchemaExtractor()
-            extractor.save_schema_to_file(schema_file, include_sample_data=True)
-            logger.info(f"Schema saved to {schema_file}")
+        await asyncio.to_thread(_ensure_schema_file, schema_file, app.state.conn_str)
         
         # Load schema for prompts
-        app.state.extractor = SchemaExtractor()
-        app.state.schema_for_prompt = app.state.extractor.get_formatted_schema_for_prompt(include_sample_data=False)
+        app.state.extractor = SchemaExtractor(connection_string=app.state.conn_str)
+        # Cached on disk per schema version, so restarts with an unchanged schema skip extraction
+        app.state.schema_for_prompt = await asyncio.to_thread(
+            app.state.extractor.get_formatted_schema_for_prompt, include_sample_data=False
+        )
         logger.info("Schema loaded for prompts")
         
-        # Generate few-shot examples
-        app.state.examples = generate_few_shot_examples()
-        logger.info("Few-shot examples generated")
+        # Stable key so OpenAI routes requests sharing the schema prefix to the same cache
+        app.state.schema_version = hashlib.sha256(app.state.schema_for_prompt.encode()).hexdigest()
+        app.state.prompt_cache_key = f"text-to-sql-{app.state.schema_version[:16]}"
+        
+        # Cache generated SQL for repeated questions (1 hour TTL)
+        app.state.response_cache = ResponseCache(ttl=3600, similarity_threshold=0.95)
+        
+        # The prompt prefix only depends on startup state, so build it once
+        app.state.prompt_prefix = generate_system_prompt()
+        # Prompt caching only kicks in for prefixes of 1024+ tokens (roughly 4 characters per token)
+        logger.info(f"Prompt prefix built: {len(app.state.prompt_prefix)} characters")
         
         # Initialize the SQL validator
-        import sql_validator
-        app.state.db_metadata = sql_validator.refresh_schemas_and_columns()
+        app.state.db_metadata = await asyncio.to_thread(sql_validator.refresh_schemas_and_columns)
         logger.info(f"Loaded database metadata: {len(app.state.db_metadata['schemas'])} schemas, {len(app.state.db_metadata['tables'])} tables")
     except Exception as e:
         logger.error(f"Error during startup: {e}")
         # Continue startup even if schema extraction fails
 
-def generate_few_shot_examples():
-    """Generate few-shot examples for the prompt"""
-    return """
+def _ensure_schema_file(schema_file: str, connection_string: str):
+    """Extract the schema to `schema_file` if it doesn't exist yet"""
+    if not os.path.exists(schema_file):
+        logger.info("Schema file not found. Extracting schema...")
+        extractor = SchemaExtractor(connection_string=connection_string)
+        extractor.save_schema_to_file(schema_file, include_sample_data=True)
+        logger.info(f"Schema saved to {schema_file}")
+
+# Few-shot examples for the prompt
+FEW_SHOT_EXAMPLES: Final[str] = """
             Example 1:
             Question: Show me the top 5 customers by total purchase amount
             SQL: 
@@ -200,71 +248,139 @@ def generate_few_shot_examples():
                 pc.Name;
             """
 
-def generate_prompt(question: str):
-    """Generate a prompt for the OpenAI API"""
-    return f"""You are a SQL expert assistant that converts natural language questions to SQL queries for the AdventureWorks database.
+# Compacted copy of the examples above: the same questions and SQL without layout whitespace,
+# about 40% fewer characters (2506 -> 1483). The token saving is smaller, since runs of
+# indentation already encode as single tokens. Set COMPRESSED_EXAMPLES=false to A/B test
+# generation quality against the original layout.
+FEW_SHOT_EXAMPLES_COMPRESSED: Final[str] = """Question: Show me the top 5 customers by total purchase amount
+SQL: SELECT TOP 5 c.CustomerID, CONCAT(p.FirstName, ' ', p.LastName) AS CustomerName, SUM(soh.TotalDue) AS TotalPurchaseAmount FROM Sales.Customer c JOIN Person.Person p ON c.PersonID = p.BusinessEntityID JOIN Sales.SalesOrderHeader soh ON c.CustomerID = soh.CustomerID GROUP BY c.CustomerID, CONCAT(p.FirstName, ' ', p.LastName) ORDER BY SUM(soh.TotalDue) DESC;
 
-            Database Schema:
-            {app.state.schema_for_prompt}
+Question: Products with no sales in the last 6 months
+SQL: SELECT p.ProductID, p.Name AS ProductName FROM Production.Product p WHERE p.ProductID NOT IN (SELECT DISTINCT sd.ProductID FROM Sales.SalesOrderDetail sd JOIN Sales.SalesOrderHeader sh ON sd.SalesOrderID = sh.SalesOrderID WHERE sh.OrderDate >= DATEADD(MONTH, -6, GETDATE()));
 
-            Examples:
-            {app.state.examples}
+Question: List employees hired in the last 5 years
+SQL: SELECT e.BusinessEntityID, p.FirstName, p.LastName, e.HireDate FROM HumanResources.Employee e JOIN Person.Person p ON e.BusinessEntityID = p.BusinessEntityID WHERE e.HireDate >= DATEADD(YEAR, -5, GETDATE()) ORDER BY e.HireDate DESC;
 
-            User Question: "{question}"
+Question: Average order quantity by product category
+SQL: SELECT pc.Name AS CategoryName, AVG(sod.OrderQty) AS AverageOrderQuantity FROM Production.ProductCategory pc JOIN Production.ProductSubcategory psc ON pc.ProductCategoryID = psc.ProductCategoryID JOIN Production.Product p ON psc.ProductSubcategoryID = p.ProductSubcategoryID JOIN Sales.SalesOrderDetail sod ON p.ProductID = sod.ProductID GROUP BY pc.Name ORDER BY pc.Name;"""
 
-            Generate a SQL query that answers this question. The query should be syntactically correct for ODBC Driver 17 for SQL Server. Format your response as follows:
+PROMPT_EXAMPLES = (
+    FEW_SHOT_EXAMPLES_COMPRESSED
+    if os.getenv("COMPRESSED_EXAMPLES", "true").lower() == "true"
+    else FEW_SHOT_EXAMPLES
+)
 
-            SQL: <the SQL query>
+SYSTEM_PREAMBLE = "You are a SQL expert assistant that converts natural language questions to SQL queries for the AdventureWorks database."
 
-            Explanation: <brief explanation of the query>
+SECURITY_RULES = """Generate a SQL query that answers the user question. The query should be syntactically correct for ODBC Driver 17 for SQL Server. Format your response as follows:
 
-            Remember these important security guidelines:
-            1. Only write SELECT statements (no INSERT, UPDATE, DELETE, DROP, etc.)
-            2. Never include multiple statements (no semicolons followed by another statement)
-            3. Never use comments (no -- or /* */)
-            4. Always use the proper AdventureWorks schema prefixes (Person, HumanResources, Production, Sales)
+SQL: <the SQL query>
 
-            Do not include any other text in your response.
-            """
+Explanation: <brief explanation of the query>
+
+Remember these important security guidelines:
+1. Only write SELECT statements (no INSERT, UPDATE, DELETE, DROP, etc.)
+2. Never include multiple statements (no semicolons followed by another statement)
+3. Never use comments (no -- or /* */)
+4. Always use the proper AdventureWorks schema prefixes (Person, HumanResources, Production, Sales)
+
+Do not include any other text in your response."""
+
+def generate_system_prompt():
+    """
+    Build the static part of the prompt (schema, examples and rules).
+    It must stay byte-identical across requests so OpenAI's prefix cache can reuse it.
+    """
+    return f"""{SYSTEM_PREAMBLE}
+
+Database Schema:
+{app.state.schema_for_prompt}
+
+Examples:
+{PROMPT_EXAMPLES}
+
+{SECURITY_RULES}"""
+
+def generate_prompt(question: str):
+    """Generate the chat messages for the OpenAI API, with the user question last"""
+    return [
+        {"role": "system", "content": app.state.prompt_prefix},
+        {"role": "user", "content": f'User Question: "{question}"'}
+    ]
+
+def _parse_llm_response(content: str):
+    """Extract the SQL and explanation from a "SQL: ... Explanation: ..." response"""
+    match = RESPONSE_RE.search(content)
+    if not match:
+        return "", ""
+    return match.group("sql").strip(), (match.group("explanation") or "").strip()
+
+async def embed_question(question: str):
+    """Embed a question for the semantic response cache, or return None on failure"""
+    try:
+        response = await app.state.oai.embeddings.create(model=EMBEDDING_MODEL, input=question)
+        return response.data[0].embedding
+    except Exception as e:
+        logger.warning(f"Error embedding question, skipping semantic cache: {e}")
+        return None
+
+def generate_feedback_prompt(question: str, previous_sql: str, error: str):
+    """
+    Generate the chat messages for correcting a failed query.
+    Reuses the cached system prompt so only the correction request is new input.
+    """
+    return [
+        {"role": "system", "content": app.state.prompt_prefix},
+        {"role": "user", "content": f"""User Question: "{question}"
+
+Previous SQL Attempt:
+{previous_sql}
+
+Error Received:
+{error}
+
+Please generate a corrected SQL query that fixes this error, using the same response format. In the explanation, briefly describe what was wrong and how you fixed it."""}
+    ]
 
 async def generate_sql(question: str):
     """Generate SQL from natural language using OpenAI"""
+    cache = app.state.response_cache
+    cache_key = ResponseCache.make_key(question, app.state.schema_version, OPENAI_MODEL, OPENAI_TEMPERATURE)
+    
+    # Serve repeated questions from the exact tier, then near-identical ones from the semantic tier
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # A similar question with different numbers or quoted values needs different SQL
+    literals = extract_literals(question)
+    embedding = await embed_question(question) if SEMANTIC_CACHE else None
+    if embedding is not None:
+        cached = cache.get_similar(embedding, literals)
+        if cached is not None:
+            return cached
+    
     try:
-        prompt = generate_prompt(question)
-        
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",  # Or your preferred model
-            messages=[
-                {"role": "system", "content": "You are a SQL expert that converts natural language questions to SQL queries."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,  # Lower temperature for more deterministic outputs
-            max_tokens=1000
+        response = await app.state.oai.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=generate_prompt(question),
+            temperature=OPENAI_TEMPERATURE,
+            max_tokens=1000,
+            extra_body={"prompt_cache_key": app.state.prompt_cache_key}
         )
         
         # Extract SQL and explanation from response
         content = response.choices[0].message.content.strip()
         
-        # Parse the output to extract SQL and explanation
-        sql = ""
-        explanation = ""
-        
-        lines = content.split("\n")
-        for i, line in enumerate(lines):
-            if line.startswith("SQL:"):
-                sql = "\n".join(lines[i+1:])
-                sql = sql.split("Explanation:")[0].strip()
-                break
-        
-        for i, line in enumerate(lines):
-            if line.startswith("Explanation:"):
-                explanation = "\n".join(lines[i+1:]).strip()
-                break
+        sql, explanation = _parse_llm_response(content)
         
         # Validate the generated SQL
         import sql_validator
         validation_result = sql_validator.get_sql_analysis(sql)
         
+        if validation_result["is_valid"]:
+            cache.set(cache_key, (sql, explanation, validation_result), embedding, literals)
+        
         return sql, explanation, validation_result
     except Exception as e:
         logger.error(f"Error generating SQL: {e}")
@@ -273,108 +389,174 @@ async def generate_sql(question: str):
 async def generate_sql_with_feedback(question: str, previous_sql: str, error: str):
     """Generate improved SQL based on error feedback"""
     try:
-        prompt = f"""You are a SQL expert assistant that converts natural language questions to SQL queries for the AdventureWorks database.
-
-            Database Schema:
-            {app.state.schema_for_prompt}
-
-            User Question: "{question}"
-
-            Previous SQL Attempt:
-            {previous_sql}
-
-            Error Received:
-            {error}
-
-            Please generate a corrected SQL query that fixes this error. The query should be syntactically correct for ODBC Driver 17 for SQL Server. Format your response as follows:
-
-            SQL: <the corrected SQL query>
-
-            Explanation: <brief explanation of what was wrong and how you fixed it>
-
-            Remember these important security guidelines:
-            1. Only write SELECT statements (no INSERT, UPDATE, DELETE, DROP, etc.)
-            2. Never include multiple statements (no semicolons followed by another statement)
-            3. Never use comments (no -- or /* */)
-            4. Always use the proper AdventureWorks schema prefixes (Person, HumanResources, Production, Sales)
-
-            Do not include any other text in your response.
-            """
-        
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",  # Or your preferred model
-            messages=[
-                {"role": "system", "content": "You are a SQL expert that fixes incorrect SQL queries."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2,  # Lower temperature for more deterministic outputs
-            max_tokens=1000
+        response = await app.state.oai.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=generate_feedback_prompt(question, previous_sql, error),
+            temperature=OPENAI_TEMPERATURE,
+            max_tokens=1000,
+            extra_body={"prompt_cache_key": app.state.prompt_cache_key}
         )
         
         # Extract SQL and explanation from response
         content = response.choices[0].message.content.strip()
         
-        # Parse the output to extract SQL and explanation
-        sql = ""
-        explanation = ""
-        
-        lines = content.split("\n")
-        for i, line in enumerate(lines):
-            if line.startswith("SQL:"):
-                sql = "\n".join(lines[i+1:])
-                sql = sql.split("Explanation:")[0].strip()
-                break
-        
-        for i, line in enumerate(lines):
-            if line.startswith("Explanation:"):
-                explanation = "\n".join(lines[i+1:]).strip()
-                break
+        sql, explanation = _parse_llm_response(content)
         
         return sql, explanation
     except Exception as e:
         logger.error(f"Error generating SQL with feedback: {e}")
         raise HTTPException(status_code=500, detail=f"Error generating SQL with feedback: {str(e)}")
 
-def execute_sql(sql: str):
-    """Execute SQL query and return results"""
+def _stringify_binary(row, binary_columns: List[int]):
+    """Convert the binary values of a row to strings so they can be serialized"""
+    values = list(row)
+    for i in binary_columns:
+        if values[i] is not None:
+            values[i] = str(values[i])
+    return values
+
+def _is_transient_error(error: Exception):
+    """Check whether a database error is likely to succeed when retried unchanged"""
+    if not isinstance(error, pyodbc.Error) or not error.args:
+        return False
+    # SQLSTATE class 08 covers every connection failure
+    return error.args[0] in TRANSIENT_SQLSTATES or str(error.args[0]).startswith("08")
+
+async def start_sql(sql: str):
+    """
+    Execute SQL query on a pooled connection without fetching its rows
+    Returns (query, execution_time, error, transient), where query is the (connection, cursor)
+    list to read rows from and release with close_query, and transient flags retriable errors
+    """
+    conn = cursor = None
     try:
         # Check if it's a SELECT statement first
         if not sql_validator.is_select_statement(sql):
-            return None, None, "Only SELECT statements are allowed for security reasons"
-            
-        # Use Windows Authentication
-        connection_string = (
-           f"""
-    DRIVER={{ODBC Driver 17 for SQL Server}};
-    SERVER={os.getenv('DB_SERVER')};
-    DATABASE={os.getenv('DB_NAME')};
-    UID={os.getenv('DB_USER')};
-    PWD={os.getenv('DB_PASSWORD')};
-"""
-        )
+            return None, None, "Only SELECT statements are allowed for security reasons", False
         
-        conn = pyodbc.connect(connection_string)
-        cursor = conn.cursor()
+        try:
+            conn = await db.acquire()
+            cursor = await conn.cursor()
+        except Exception as e:
+            # The SQL never ran, so this is worth retrying as is rather than asking the model to fix it
+            logger.error(f"Error connecting to database: {e}")
+            if conn is not None:
+                await db.release(conn)
+            return None, None, str(e), True
         
         start_time = time.time()
-        cursor.execute(sql)
+        await cursor.execute(sql)
         execution_time = time.time() - start_time
         
-        # Get column names
-        columns = [column[0] for column in cursor.description]
-        
-        # Fetch results
+        return [conn, cursor], execution_time, None, False  # Return None for error
+    except Exception as e:
+        logger.error(f"Error executing SQL: {e}")
+        if conn is not None:
+            await close_query([conn, cursor])
+        return None, None, str(e), _is_transient_error(e)  # Return the error as a string
+
+async def close_query(query):
+    """
+    Close the cursor of a query started with start_sql and return its connection to the pool
+    Safe to call more than once; only the first call releases the connection
+    """
+    conn, cursor = query
+    if conn is None:
+        return
+    query[0] = query[1] = None
+    try:
+        if cursor is not None:
+            await cursor.close()
+    finally:
+        await db.release(conn)
+
+async def iter_result_batches(cursor, batch_size: int = FETCH_BATCH_SIZE):
+    """Yield the rows of an executed query as lists of dicts, one batch at a time"""
+    # Get column names, and find binary columns once instead of checking every value
+    columns = tuple(column[0] for column in cursor.description)
+    binary_columns = [i for i, column in enumerate(cursor.description) if column[1] in (bytes, bytearray)]
+    
+    while True:
+        rows = await cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        if binary_columns:
+            rows = [_stringify_binary(row, binary_columns) for row in rows]
+        yield [dict(zip(columns, row)) for row in rows]
+
+async def execute_sql(sql: str):
+    """
+    Execute SQL query and return results
+    Returns (results, execution_time, error, transient), where transient flags retriable errors
+    """
+    query, execution_time, error, transient = await start_sql(sql)
+    if error:
+        return None, None, error, transient
+    
+    try:
+        # Fetch results in batches to limit peak memory on large result sets
         results = []
-        for row in cursor.fetchall():
-            results.append(dict(zip(columns, [str(x) if isinstance(x, (bytes, bytearray)) else x for x in row])))
+        async for batch in iter_result_batches(query[1]):
+            results.extend(batch)
+        return results, execution_time, None, False
+    except Exception as e:
+        logger.error(f"Error fetching SQL results: {e}")
+        return None, None, str(e), _is_transient_error(e)
+    finally:
+        await close_query(query)
+
+def _json_default(value):
+    """Serialize values orjson doesn't support natively, matching FastAPI's encoders"""
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    return str(value)
+
+async def stream_execution_response(query, execution_time: float, retry_count: int):
+    """
+    Stream an ExecutionResponse body for a started query, encoding rows batch by batch
+    so large result sets are never held in memory all at once
+    """
+    error = None
+    try:
+        yield b'{"results":['
         
-        cursor.close()
-        conn.close()
+        first = True
+        try:
+            async for batch in iter_result_batches(query[1], STREAM_BATCH_SIZE):
+                # Drop the list brackets so batches join into a single JSON array
+                chunk = orjson.dumps(batch, default=_json_default)[1:-1]
+                yield chunk if first else b"," + chunk
+                first = False
+        except Exception as e:
+            # The status line is already sent, so report the error in the body after the rows read so far
+            logger.error(f"Error streaming SQL results: {e}")
+            error = str(e)
         
-        return results, execution_time, None  # Return None for error
-    except Exception as e:
-        logger.error(f"Error executing SQL: {e}")
-        return None, None, str(e)  # Return the error as a string
+        yield b'],"execution_time":' + orjson.dumps(execution_time) + \
+            b',"error":' + orjson.dumps(error) + \
+            b',"retry_count":' + orjson.dumps(retry_count) + b"}"
+    finally:
+        await close_query(query)
+
+class QueryStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that releases its query's connection even if the body iterator never runs,
+    e.g. when the client disconnects before the response starts
+    """
+    def __init__(self, query, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query = query
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await close_query(self.query)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.oai.close()
+    await db.close_pool()
 
 @app.post("/generate-sql", response_model=SqlGenerationResponse)
 async def generate_sql_endpoint(request: QueryRequest):
@@ -397,12 +579,16 @@ async def execute_sql_endpoint(request: ExecuteSqlRequest, response: Response):
     """Execute the provided SQL query"""
     max_attempts = 3  # Maximum number of retry attempts
     attempt = 0
+    validated_sql = None
+    tried_sql = set()
     
     while attempt < max_attempts:
         attempt += 1
         try:
-            # Validate the SQL first
-            validation_result = sql_validator.get_sql_analysis(request.sql)
+            # Validate the SQL first, skipping it when a retry reuses the same SQL
+            if request.sql != validated_sql:
+                validation_result = sql_validator.get_sql_analysis(request.sql)
+                validated_sql = request.sql
             if not validation_result["is_valid"]:
                 return {
                     "results": None,
@@ -411,28 +597,49 @@ async def execute_sql_endpoint(request: ExecuteSqlRequest, response: Response):
                     "retry_count": 0
                 }
             
-            # Execute the SQL
-            results, execution_time, error = execute_sql(request.sql)
+            # Execute the SQL; rows are fetched while the response streams
+            query, execution_time, error, transient = await start_sql(request.sql)
+            tried_sql.add(request.sql)
             
-            # If there's an error and we have attempts left, try to correct the SQL
+            # If there's an error and we have attempts left, retry or try to correct the SQL
             if error and attempt < max_attempts:
+                # Transient errors (timeouts, deadlocks, dropped connections) are worth retrying as is
+                if transient:
+                    logger.info(f"Attempt {attempt}: Retrying after transient database error")
+                    await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                    continue
+                
                 # Generate corrected SQL based on the error
                 logger.info(f"Attempt {attempt}: Retrying with error feedback")
                 question = "Fix the SQL query"  # Generic placeholder since we don't have the original question
                 sql, explanation = await generate_sql_with_feedback(question, request.sql, error)
-                request.sql = sql  # Update the SQL for the next attempt
-                continue  # Continue to the next attempt with the corrected SQL
+                
+                # Stop when the model oscillates back to SQL that already failed
+                if sql not in tried_sql:
+                    request.sql = sql  # Update the SQL for the next attempt
+                    continue  # Continue to the next attempt with the corrected SQL
+                logger.info(f"Attempt {attempt}: Corrected SQL was already tried, not retrying")
             
-            # Add retry count header
-            if attempt > 1:
-                response.headers["X-Retry-Count"] = str(attempt - 1)
+            retry_count = attempt - 1 if attempt > 1 else 0
             
-            return {
-                "results": results,
-                "execution_time": execution_time,
-                "error": error,
-                "retry_count": attempt - 1 if attempt > 1 else 0
-            }
+            if error:
+                # Add retry count header
+                if attempt > 1:
+                    response.headers["X-Retry-Count"] = str(retry_count)
+                
+                return {
+                    "results": None,
+                    "execution_time": None,
+                    "error": error,
+                    "retry_count": retry_count
+                }
+            
+            return QueryStreamingResponse(
+                query,
+                stream_execution_response(query, execution_time, retry_count),
+                media_type="application/json",
+                headers={"X-Retry-Count": str(retry_count)} if attempt > 1 else None
+            )
         except Exception as e:
             logger.error(f"Error executing SQL: {e}")
             if attempt >= max_attempts:
@@ -442,7 +649,8 @@ async def execute_sql_endpoint(request: ExecuteSqlRequest, response: Response):
                     "error": str(e),
                     "retry_count": attempt - 1
                 }
-            # If we have attempts left, try again
+            # If we have attempts left, try again after backing off
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
 
 @app.post("/query")
 async def legacy_query_endpoint(request: QueryRequest, response: Response):
@@ -464,7 +672,7 @@ async def legacy_query_endpoint(request: QueryRequest, response: Response):
             }
         
         # Execute SQL
-        results, execution_time, error = execute_sql(sql)
+        results, execution_time, error, _ = await execute_sql(sql)
         
         return {
             "sql": sql,
@@ -477,6 +685,11 @@ async def legacy_query_endpoint(request: QueryRequest, response: Response):
         logger.error(f"Error in legacy query endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _persist_feedback(feedback_file: str, record: Dict[str, Any]):
+    """Append one feedback record as a JSON line"""
+    with open(feedback_file, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
 @app.post("/feedback")
 async def feedback(request: FeedbackRequest):
     """Store feedback for improving the system"""
@@ -485,30 +698,19 @@ async def feedback(request: FeedbackRequest):
         # For this prototype, just log it
         logger.info(f"Feedback received: {request.dict()}")
         
-        # Store feedback in a JSON file for analysis
+        # Append feedback to a JSON Lines file for analysis (read it back with pd.read_json(..., lines=True))
         try:
-            feedback_file = "feedback_data.json"
-            
-            # Load existing feedback if the file exists
-            if os.path.exists(feedback_file):
-                with open(feedback_file, 'r') as f:
-                    feedback_data = json.load(f)
-            else:
-                feedback_data = []
-            
-            # Add the new feedback
-            feedback_data.append({
+            feedback_file = "feedback_data.jsonl"
+            record = {
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
                 "question": request.question,
                 "sql": request.sql,
                 "is_correct": request.is_correct,
                 "corrected_sql": request.corrected_sql,
                 "additional_feedback": request.additional_feedback
-            })
+            }
             
-            # Save the updated feedback
-            with open(feedback_file, 'w') as f:
-                json.dump(feedback_data, f, indent=2)
+            await asyncio.to_thread(_persist_feedback, feedback_file, record)
             
             logger.info(f"Feedback saved to {feedback_file}")
         except Exception as e:
@@ -0,0 +1,155 @@
+"""
+db.py: Shared database connection settings, plus the async connection pool used by the API
+"""
+import os
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pyodbc
+import aioodbc
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Let the ODBC driver manager reuse connections across connect() calls; must be set before the first one
+pyodbc.pooling = True
+
+def _build_connection_string():
+    return (
+        "DRIVER={ODBC Driver 17 for SQL Server};"
+        f"SERVER={os.getenv('DB_SERVER')};"
+        f"DATABASE={os.getenv('DB_NAME')};"
+        f"UID={os.getenv('DB_USER')};"
+        f"PWD={os.getenv('DB_PASSWORD')};"
+    )
+
+# Built once; the environment doesn't change while the process runs
+CONNECTION_STRING = _build_connection_string()
+
+# On-disk caches of schema-derived data, keyed by schema version
+CACHE_DIR = os.path.expanduser(os.getenv("T2SQL_CACHE_DIR", "~/.cache/t2sql"))
+
+SCHEMA_VERSION_QUERY = """
+SELECT 
+    (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(name, modify_date)) FROM sys.objects),
+    (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(name)) FROM sys.schemas)
+"""
+
+# Rows fetched per round trip when reading metadata result sets
+FETCH_SIZE = 1000
+
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+# pyodbc calls block, so the pool runs them on dedicated threads instead of the event loop's default executor
+POOL_WORKERS = 16
+
+_pool = None
+_executor = None
+# Created on first use so it belongs to the running event loop
+_pool_lock = None
+
+def connect(connection_string=None):
+    """Open a blocking connection, by default to the database configured in the environment"""
+    return pyodbc.connect(connection_string or CONNECTION_STRING, autocommit=True)
+
+def iter_rows(cursor, size=FETCH_SIZE):
+    """Yield a blocking cursor's rows in fetchmany batches rather than materializing the whole result set"""
+    cursor.arraysize = size
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
+
+def get_schema_version(connection_string=None):
+    """
+    Return a cheap token that changes whenever the database schema changes, or None if it can't be read
+    Altering a table updates its modify_date in sys.objects, so the checksum covers column changes too
+    """
+    connection_string = connection_string or CONNECTION_STRING
+    try:
+        conn = connect(connection_string)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(SCHEMA_VERSION_QUERY)
+            objects_checksum, schemas_checksum = cursor.fetchone()
+            cursor.close()
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error fetching schema version: {e}")
+        return None
+
+    # Include the connection string so different databases never share a cache entry
+    token = f"{connection_string}/{objects_checksum}/{schemas_checksum}"
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+def write_cache_file(path, text):
+    """
+    Atomically write text to a cache file, creating its directory if needed
+    Writes a temporary file first so concurrent processes never read a partial cache;
+    the temporary file is removed if anything fails, and the error is re-raised
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+async def create_pool(connection_string=None):
+    """Open the shared connection pool"""
+    global _pool, _executor
+    # Keep the worker threads across failed attempts instead of leaking a new executor each time
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=POOL_WORKERS, thread_name_prefix="db")
+    _pool = await aioodbc.create_pool(
+        dsn=connection_string or CONNECTION_STRING,
+        minsize=POOL_MIN_SIZE,
+        maxsize=POOL_MAX_SIZE,
+        executor=_executor,
+        # Queries are read-only, so skip the implicit transaction around each one
+        autocommit=True
+    )
+    logger.info("Database connection pool created")
+
+async def close_pool():
+    """Close the pool and its worker threads, if they were opened"""
+    global _pool, _executor
+    if _pool is not None:
+        _pool.close()
+        await _pool.wait_closed()
+        _pool = None
+
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+async def acquire():
+    """
+    Take a connection from the pool; hand it back with release
+    The pool is created here if it doesn't exist yet, e.g. because the database
+    wasn't reachable at startup
+    """
+    global _pool_lock
+    if _pool is None:
+        if _pool_lock is None:
+            _pool_lock = asyncio.Lock()
+        async with _pool_lock:
+            if _pool is None:
+                await create_pool()
+    return await _pool.acquire()
+
+async def release(conn):
+    """Return a connection taken with acquire to the pool"""
+    await _pool.release(conn)
@@ -0,0 +1,143 @@
+"""
+response_cache.py: Exact and semantic cache for generated SQL responses
+"""
+import hashlib
+import json
+import threading
+import re
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Numbers and quoted strings; questions that differ in these need different SQL however similar they are
+LITERAL_RE = re.compile(r"\d+(?:\.\d+)?|'[^']*'|\"[^\"]*\"")
+
+def extract_literals(question):
+    """Return the literals of a question, in order, for matching semantic cache hits"""
+    return tuple(LITERAL_RE.findall(question))
+
+class ResponseCache:
+    def __init__(self, ttl=3600, similarity_threshold=0.95, max_entries=1024):
+        """
+        Two-tier cache for LLM responses
+        - exact tier: dict keyed by a hash of the question and generation settings
+        - semantic tier: question embeddings matched by cosine similarity
+        """
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+
+        # key -> (value, expires_at)
+        self._entries = {}
+
+        # Semantic tier: normalized embeddings stacked row-wise, aligned with _embedding_keys
+        # and the literals of each question in _embedding_literals
+        self._embeddings = None
+        self._embedding_keys = []
+        self._embedding_literals = []
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(question, schema_version, model, temperature):
+        """Build the exact-match key for a question and its generation settings"""
+        payload = json.dumps({
+            "q": question,
+            "schema": schema_version,
+            "model": model,
+            "temp": temperature
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached value for an exact key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                self._remove(key)
+                return None
+            return value
+
+    def get_similar(self, embedding, literals=()):
+        """
+        Return the cached value whose question embedding is closest to `embedding`, or None
+        Only questions with the same literals (see extract_literals) can match
+        """
+        with self._lock:
+            if self._embeddings is None:
+                return None
+
+            scores = self._embeddings @ self._normalize(embedding)
+            # Skip expired entries too, so they can't hide a live match below them
+            now = time.time()
+            excluded = [
+                i for i, (key, entry_literals) in enumerate(zip(self._embedding_keys, self._embedding_literals))
+                if entry_literals != literals or self._entries[key][1] < now
+            ]
+            scores[excluded] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+
+            value = self._entries[self._embedding_keys[best]][0]
+
+        logger.info(f"Semantic cache hit (similarity {scores[best]:.3f})")
+        return value
+
+    def set(self, key, value, embedding=None, literals=()):
+        """Store a value, optionally indexing its question embedding and literals for semantic lookups"""
+        with self._lock:
+            # Replace an existing entry before evicting, so re-setting a key never evicts another one
+            if key in self._entries:
+                self._remove(key)
+            self._evict()
+
+            self._entries[key] = (value, time.time() + self.ttl)
+
+            if embedding is not None:
+                row = self._normalize(embedding)[np.newaxis, :]
+                if self._embeddings is None:
+                    self._embeddings = row
+                else:
+                    self._embeddings = np.vstack([self._embeddings, row])
+                self._embedding_keys.append(key)
+                self._embedding_literals.append(literals)
+
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+            self._embeddings = None
+            self._embedding_keys = []
+            self._embedding_literals = []
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _evict(self):
+        """Drop expired entries, then the oldest ones if the cache is still full"""
+        now = time.time()
+        for key in [k for k, (_, expires_at) in self._entries.items() if expires_at < now]:
+            self._remove(key)
+
+        # dicts keep insertion order, so the first keys are the oldest
+        while len(self._entries) >= self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if key in self._embedding_keys:
+            index = self._embedding_keys.index(key)
+            del self._embedding_keys[index]
+            del self._embedding_literals[index]
+            self._embeddings = np.delete(self._embeddings, index, axis=0)
+            if not self._embedding_keys:
+                self._embeddings = None
@@ -1,328 +1,507 @@
 """
 schema_extractor.py: Extracts schema information from AdventureWorks database
 """
-import pyodbc
+import io
 import json
 import os
+from functools import lru_cache
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from db import CACHE_DIR, CONNECTION_STRING, connect, get_schema_version, iter_rows, write_cache_file
 
 # Load environment variables
 load_dotenv()
 
+# Concurrent sample data queries; kept small so extraction doesn't exhaust the server's connections
+SAMPLE_DATA_WORKERS = 8
+
+# Types left out of sample queries: large values, or CLR types pyodbc can't read
+# (n)varchar(max) and varbinary(max) columns are recognized by their max_length of -1 instead
+LOB_TYPES = frozenset({"text", "ntext", "image", "xml", "geography", "geometry", "hierarchyid"})
+
+# Query to get columns and their descriptions; {filter} is an optional WHERE clause
+COLUMNS_QUERY = """
+    SELECT 
+        s.name AS schema_name,
+        tbl.name AS table_name,
+        c.name AS column_name,
+        t.name AS data_type,
+        c.max_length,
+        c.precision,
+        c.scale,
+        c.is_nullable,
+        ISNULL(ep.value, '') AS column_description,
+        CASE WHEN pk.column_id IS NOT NULL THEN 1 ELSE 0 END AS is_primary_key,
+        CASE WHEN fk.parent_column_id IS NOT NULL THEN 1 ELSE 0 END AS is_foreign_key
+    FROM 
+        sys.columns c
+    INNER JOIN 
+        sys.types t ON c.user_type_id = t.user_type_id
+    INNER JOIN 
+        sys.tables tbl ON c.object_id = tbl.object_id
+    LEFT JOIN 
+        sys.schemas s ON tbl.schema_id = s.schema_id
+    LEFT JOIN 
+        sys.extended_properties ep ON ep.major_id = c.object_id 
+        AND ep.minor_id = c.column_id 
+        AND ep.name = 'MS_Description'
+    LEFT JOIN 
+        sys.index_columns pk ON pk.object_id = c.object_id 
+        AND pk.column_id = c.column_id 
+        AND EXISTS (
+            SELECT 1 FROM sys.indexes i 
+            WHERE i.object_id = pk.object_id 
+            AND i.index_id = pk.index_id 
+            AND i.is_primary_key = 1
+        )
+    LEFT JOIN 
+        sys.foreign_key_columns fk ON fk.parent_object_id = c.object_id 
+        AND fk.parent_column_id = c.column_id
+    {filter}
+    ORDER BY 
+        s.name, tbl.name, c.column_id
+"""
+
+# Query to get all tables and their descriptions
+TABLES_QUERY = """
+    SELECT 
+        t.name AS table_name,
+        SCHEMA_NAME(t.schema_id) AS schema_name,
+        ISNULL(ep.value, '') AS table_description
+    FROM 
+        sys.tables t
+    LEFT JOIN 
+        sys.extended_properties ep 
+        ON ep.major_id = t.object_id 
+        AND ep.minor_id = 0 
+        AND ep.name = 'MS_Description'
+    ORDER BY 
+        schema_name, table_name
+"""
+
+# Query to get all foreign key relationships
+RELATIONSHIPS_QUERY = """
+    SELECT 
+        fk.name AS fk_name,
+        ps.name AS parent_schema,
+        pt.name AS parent_table,
+        pc.name AS parent_column,
+        rs.name AS referenced_schema,
+        rt.name AS referenced_table,
+        rc.name AS referenced_column
+    FROM 
+        sys.foreign_keys fk
+    INNER JOIN 
+        sys.foreign_key_columns fkc ON fk.object_id = fkc.constraint_object_id
+    INNER JOIN 
+        sys.tables pt ON fkc.parent_object_id = pt.object_id
+    INNER JOIN 
+        sys.schemas ps ON pt.schema_id = ps.schema_id
+    INNER JOIN 
+        sys.columns pc ON fkc.parent_object_id = pc.object_id AND fkc.parent_column_id = pc.column_id
+    INNER JOIN 
+        sys.tables rt ON fkc.referenced_object_id = rt.object_id
+    INNER JOIN 
+        sys.schemas rs ON rt.schema_id = rs.schema_id
+    INNER JOIN 
+        sys.columns rc ON fkc.referenced_object_id = rc.object_id AND fkc.referenced_column_id = rc.column_id
+    ORDER BY 
+        ps.name, pt.name, fk.name
+"""
+
+# Tables, columns and relationships as one batch with three result sets, in that order
+# NOCOUNT stops row counts from being returned ahead of the result sets
+SCHEMA_BATCH_QUERY = ";\n".join([
+    "SET NOCOUNT ON",
+    TABLES_QUERY,
+    COLUMNS_QUERY.format(filter=""),
+    RELATIONSHIPS_QUERY
+])
+
+# Bump when the prompt text format or what goes into it changes, so stale cached text is ignored
+PROMPT_FORMAT_VERSION = 2
+
+# Column suffixes for the prompt, keyed by (is_primary_key, is_foreign_key)
+KEY_INDICATORS = {
+    (False, False): "",
+    (True, False): " [PK]",
+    (False, True): " [FK]",
+    (True, True): " [PK, FK]"
+}
+
+# One row of COLUMNS_QUERY after its schema_name and table_name columns
+Column = namedtuple("Column", [
+    "column_name", "data_type", "max_length", "precision", "scale",
+    "is_nullable", "description", "is_primary_key", "is_foreign_key"
+])
+
+def _escape_identifier(name):
+    """Escape a name for use inside [brackets]"""
+    return name.replace("]", "]]")
+
+def _sample_columns(columns):
+    """Names of the columns worth sampling: everything but large-object and spatial/CLR types"""
+    return [
+        column.column_name for column in columns
+        if column.data_type not in LOB_TYPES and column.max_length != -1
+    ]
+
+def _read_tables(cursor):
+    """Read a TABLES_QUERY result set"""
+    return [
+        {
+            "table_name": row.table_name,
+            "schema_name": row.schema_name,
+            "description": row.table_description
+        }
+        for row in iter_rows(cursor)
+    ]
+
+def _read_all_columns(cursor):
+    """Read an unfiltered COLUMNS_QUERY result set into a dict keyed by (schema_name, table_name)"""
+    columns = {}
+    for row in iter_rows(cursor):
+        columns.setdefault((row.schema_name, row.table_name), []).append(Column._make(row[2:]))
+    return columns
+
+def _read_relationships(cursor):
+    """Read a RELATIONSHIPS_QUERY result set"""
+    return [
+        {
+            "fk_name": row.fk_name,
+            "parent_schema": row.parent_schema,
+            "parent_table": row.parent_table,
+            "parent_column": row.parent_column,
+            "referenced_schema": row.referenced_schema,
+            "referenced_table": row.referenced_table,
+            "referenced_column": row.referenced_column
+        }
+        for row in iter_rows(cursor)
+    ]
+
 class SchemaExtractor:
     def __init__(self, connection_string=None):
         """Initialize with connection string or use environment variables"""
-        if connection_string:
-            self.connection_string = connection_string
-        else:
-            # Use environment variables
-            self.connection_string = (f"""
-    DRIVER={{ODBC Driver 17 for SQL Server}};
-    SERVER={os.getenv('DB_SERVER')};
-    DATABASE={os.getenv('DB_NAME')};
-    UID={os.getenv('DB_USER')};
-    PWD={os.getenv('DB_PASSWORD')};
-"""
-            )
+        self.connection_string = connection_string or CONNECTION_STRING
+        
+        # Formatted prompt schemas keyed by (schema version, include_sample_data, sample_data_limit)
+        self._formatted_schema = lru_cache(maxsize=4)(self._formatted_schema_for_version)
         
     def get_connection(self):
         """Create and return a connection to the database"""
-        if self.connection_string:
-            return pyodbc.connect(self.connection_string)
-        else:
-            # Use Trusted Connection (Windows Authentication)
-            return pyodbc.connect(f"""
-    DRIVER=SQL Server;
-    SERVER={os.getenv('DB_SERVER')};
-    DATABASE={os.getenv('DB_NAME')};
-    UID={os.getenv('DB_USER')};
-    PWD={os.getenv('DB_PASSWORD')};
-"""
-            )
+        return connect(self.connection_string)
     
-    def extract_tables(self):
-        """Extract all tables from the database"""
-        tables = []
+    @contextmanager
+    def _connection(self, conn=None):
+        """Yield `conn` if given, otherwise a new connection that is closed afterwards"""
+        if conn is not None:
+            yield conn
+            return
         
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Query to get all tables and their descriptions
-            query = """
-                SELECT 
-                    t.name AS table_name,
-                    SCHEMA_NAME(t.schema_id) AS schema_name,
-                    ISNULL(ep.value, '') AS table_description
-                FROM 
-                    sys.tables t
-                LEFT JOIN 
-                    sys.extended_properties ep 
-                    ON ep.major_id = t.object_id 
-                    AND ep.minor_id = 0 
-                    AND ep.name = 'MS_Description'
-                ORDER BY 
-                    schema_name, table_name
-                """
-            
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                tables.append({
-                    "table_name": row.table_name,
-                    "schema_name": row.schema_name,
-                    "description": row.table_description
-                })
-                
-            cursor.close()
+            yield conn
+        finally:
             conn.close()
+    
+    def extract_tables(self, conn=None):
+        """Extract all tables from the database, optionally reusing an open connection"""
+        tables = []
+        
+        try:
+            with self._connection(conn) as conn:
+                cursor = conn.cursor()
+                cursor.execute(TABLES_QUERY)
+                tables = _read_tables(cursor)
+                cursor.close()
         except Exception as e:
             print(f"Error extracting tables: {e}")
         
         return tables
     
-    def extract_columns(self, table_name, schema_name="dbo"):
-        """Extract all columns for a specific table"""
+    def extract_columns(self, table_name, schema_name="dbo", conn=None):
+        """Extract all columns for a specific table, optionally reusing an open connection"""
         columns = []
         
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Query to get all columns and their descriptions
-            query = """
-                    SELECT 
-                        c.name AS column_name,
-                        t.name AS data_type,
-                        c.max_length,
-                        c.precision,
-                        c.scale,
-                        c.is_nullable,
-                        ISNULL(ep.value, '') AS column_description,
-                        CASE WHEN pk.column_id IS NOT NULL THEN 1 ELSE 0 END AS is_primary_key,
-                        CASE WHEN fk.parent_column_id IS NOT NULL THEN 1 ELSE 0 END AS is_foreign_key
-                    FROM 
-                        sys.columns c
-                    INNER JOIN 
-                        sys.types t ON c.user_type_id = t.user_type_id
-                    INNER JOIN 
-                        sys.tables tbl ON c.object_id = tbl.object_id
-                    LEFT JOIN 
-                        sys.schemas s ON tbl.schema_id = s.schema_id
-                    LEFT JOIN 
-                        sys.extended_properties ep ON ep.major_id = c.object_id 
-                        AND ep.minor_id = c.column_id 
-                        AND ep.name = 'MS_Description'
-                    LEFT JOIN 
-                        sys.index_columns pk ON pk.object_id = c.object_id 
-                        AND pk.column_id = c.column_id 
-                        AND EXISTS (
-                            SELECT 1 FROM sys.indexes i 
-                            WHERE i.object_id = pk.object_id 
-                            AND i.index_id = pk.index_id 
-                            AND i.is_primary_key = 1
-                        )
-                    LEFT JOIN 
-                        sys.foreign_key_columns fk ON fk.parent_object_id = c.object_id 
-                        AND fk.parent_column_id = c.column_id
-                    WHERE 
-                        tbl.name = ? AND s.name = ?
-                    ORDER BY 
-                        c.column_id
-                """
-            
-            cursor.execute(query, (table_name, schema_name))
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                columns.append({
-                    "column_name": row.column_name,
-                    "data_type": row.data_type,
-                    "max_length": row.max_length,
-                    "precision": row.precision,
-                    "scale": row.scale,
-                    "is_nullable": row.is_nullable,
-                    "description": row.column_description,
-                    "is_primary_key": row.is_primary_key,
-                    "is_foreign_key": row.is_foreign_key
-                })
+            with self._connection(conn) as conn:
+                cursor = conn.cursor()
                 
-            cursor.close()
-            conn.close()
+                query = COLUMNS_QUERY.format(filter="WHERE tbl.name = ? AND s.name = ?")
+                cursor.execute(query, (table_name, schema_name))
+                for row in iter_rows(cursor):
+                    columns.append(Column._make(row[2:]))
+                    
+                cursor.close()
         except Exception as e:
             print(f"Error extracting columns for {schema_name}.{table_name}: {e}")
         
         return columns
     
-    def extract_relationships(self):
-        """Extract all foreign key relationships"""
+    def extract_all_columns(self, conn=None):
+        """
+        Extract the columns of every table in a single query
+        Returns a dict mapping (schema_name, table_name) -> list of columns
+        """
+        columns = {}
+        
+        try:
+            with self._connection(conn) as conn:
+                cursor = conn.cursor()
+                cursor.execute(COLUMNS_QUERY.format(filter=""))
+                columns = _read_all_columns(cursor)
+                cursor.close()
+        except Exception as e:
+            print(f"Error extracting columns: {e}")
+        
+        return columns
+    
+    def extract_relationships(self, conn=None):
+        """Extract all foreign key relationships, optionally reusing an open connection"""
         relationships = []
         
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Query to get all foreign key relationships
-            query = """
-                    SELECT 
-                        fk.name AS fk_name,
-                        ps.name AS parent_schema,
-                        pt.name AS parent_table,
-                        pc.name AS parent_column,
-                        rs.name AS referenced_schema,
-                        rt.name AS referenced_table,
-                        rc.name AS referenced_column
-                    FROM 
-                        sys.foreign_keys fk
-                    INNER JOIN 
-                        sys.foreign_key_columns fkc ON fk.object_id = fkc.constraint_object_id
-                    INNER JOIN 
-                        sys.tables pt ON fkc.parent_object_id = pt.object_id
-                    INNER JOIN 
-                        sys.schemas ps ON pt.schema_id = ps.schema_id
-                    INNER JOIN 
-                        sys.columns pc ON fkc.parent_object_id = pc.object_id AND fkc.parent_column_id = pc.column_id
-                    INNER JOIN 
-                        sys.tables rt ON fkc.referenced_object_id = rt.object_id
-                    INNER JOIN 
-                        sys.schemas rs ON rt.schema_id = rs.schema_id
-                    INNER JOIN 
-                        sys.columns rc ON fkc.referenced_object_id = rc.object_id AND fkc.referenced_column_id = rc.column_id
-                    ORDER BY 
-                        ps.name, pt.name, fk.name
-                    """
-            
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                relationships.append({
-                    "fk_name": row.fk_name,
-                    "parent_schema": row.parent_schema,
-                    "parent_table": row.parent_table,
-                    "parent_column": row.parent_column,
-                    "referenced_schema": row.referenced_schema,
-                    "referenced_table": row.referenced_table,
-                    "referenced_column": row.referenced_column
-                })
-                
-            cursor.close()
-            conn.close()
+            with self._connection(conn) as conn:
+                cursor = conn.cursor()
+                cursor.execute(RELATIONSHIPS_QUERY)
+                relationships = _read_relationships(cursor)
+                cursor.close()
         except Exception as e:
             print(f"Error extracting relationships: {e}")
         
         return relationships
     
-    def extract_sample_data(self, table_name, schema_name="dbo", limit=5):
-        """Extract sample data from a table"""
+    def extract_schema_metadata(self, conn=None, strict=False):
+        """
+        Extract tables, all columns and relationships in a single round trip
+        Returns (tables, columns, relationships), with columns keyed by (schema_name, table_name)
+        Errors are reported and give empty results, or are raised if `strict` is set
+        """
+        tables, columns, relationships = [], {}, []
+        
+        try:
+            with self._connection(conn) as conn:
+                cursor = conn.cursor()
+                cursor.execute(SCHEMA_BATCH_QUERY)
+                tables = _read_tables(cursor)
+                cursor.nextset()
+                columns = _read_all_columns(cursor)
+                cursor.nextset()
+                relationships = _read_relationships(cursor)
+                cursor.close()
+        except Exception as e:
+            if strict:
+                raise
+            print(f"Error extracting schema metadata: {e}")
+        
+        return tables, columns, relationships
+    
+    def extract_sample_data(self, table_name, schema_name="dbo", limit=5, conn=None, columns=None):
+        """
+        Extract sample data from a table, optionally reusing an open connection
+        Only the named columns are selected if `columns` is given, otherwise all of them
+        """
         sample_data = []
         
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Query to get sample data
-            query = f"SELECT TOP {limit} * FROM [{schema_name}].[{table_name}]"
-            
-            cursor.execute(query)
-            columns = [column[0] for column in cursor.description]
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                sample_data.append(dict(zip(columns, row)))
+            with self._connection(conn) as conn:
+                cursor = conn.cursor()
                 
-            cursor.close()
-            conn.close()
+                # Query to get sample data
+                select_list = ", ".join(f"[{_escape_identifier(name)}]" for name in columns) if columns else "*"
+                query = f"SELECT TOP {limit} {select_list} FROM [{schema_name}].[{table_name}]"
+                
+                cursor.execute(query)
+                columns = [column[0] for column in cursor.description]
+                for row in iter_rows(cursor):
+                    sample_data.append(dict(zip(columns, row)))
+                    
+                cursor.close()
         except Exception as e:
             print(f"Error extracting sample data for {schema_name}.{table_name}: {e}")
             
         return sample_data
     
-    def extract_full_schema(self, include_sample_data=True, sample_data_limit=5):
-        """Extract the full database schema with optional sample data"""
+    def extract_all_sample_data(self, tables, limit=5, max_workers=SAMPLE_DATA_WORKERS, columns=None):
+        """
+        Extract sample data for many tables in parallel
+        Each worker thread reuses its own connection; pyodbc releases the GIL while queries run
+        If `columns` maps (schema_name, table_name) -> columns, large-object columns are left out
+        Returns a dict mapping (schema_name, table_name) -> sample rows
+        """
+        local = threading.local()
+        connections = []
+        connections_lock = threading.Lock()
+        
+        def extract(table):
+            sample_columns = None
+            if columns is not None:
+                sample_columns = _sample_columns(columns.get((table["schema_name"], table["table_name"]), []))
+                if not sample_columns:
+                    return []
+            
+            conn = getattr(local, "conn", None)
+            if conn is None:
+                try:
+                    conn = local.conn = self.get_connection()
+                except Exception as e:
+                    print(f"Error connecting to database: {e}")
+                    return []
+                with connections_lock:
+                    connections.append(conn)
+            return self.extract_sample_data(
+                table["table_name"], table["schema_name"], limit, conn=conn, columns=sample_columns
+            )
+        
+        sample_data = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(extract, table): (table["schema_name"], table["table_name"])
+                    for table in tables
+                }
+                for future in as_completed(futures):
+                    sample_data[futures[future]] = future.result()
+        finally:
+            for conn in connections:
+                conn.close()
+        
+        return sample_data
+    
+    def extract_full_schema(self, include_sample_data=True, sample_data_limit=5, strict=False):
+        """
+        Extract the full database schema with optional sample data
+        If `strict` is set, a failed metadata query raises instead of giving an empty schema
+        """
+        # Fetch tables, every table's columns and relationships in one round trip
+        tables, all_columns, relationships = self.extract_schema_metadata(strict=strict)
+        
         schema = {
             "tables": [],
-            "relationships": self.extract_relationships()
+            "relationships": relationships
         }
         
-        tables = self.extract_tables()
         for table in tables:
             table_info = {
                 "name": table["table_name"],
                 "schema": table["schema_name"],
                 "description": table["description"],
-                "columns": self.extract_columns(table["table_name"], table["schema_name"])
+                "columns": all_columns.get((table["schema_name"], table["table_name"]), [])
             }
             
-            if include_sample_data:
-                table_info["sample_data"] = self.extract_sample_data(
-                    table["table_name"], 
-                    table["schema_name"],
-                    sample_data_limit
-                )
-                
             schema["tables"].append(table_info)
-            
+        
+        # Sample queries are by far the slowest part, so never run them unless asked to
+        if not include_sample_data:
+            return schema
+        
+        sample_data = self.extract_all_sample_data(tables, sample_data_limit, columns=all_columns)
+        for table_info in schema["tables"]:
+            table_info["sample_data"] = sample_data[(table_info["schema"], table_info["name"])]
+        
         return schema
     
     def save_schema_to_file(self, filename="schema.json", include_sample_data=True):
         """Extract the schema and save it to a JSON file"""
         schema = self.extract_full_schema(include_sample_data)
         
+        # Columns are named tuples; write them as objects so the file format is unchanged
+        schema = {
+            **schema,
+            "tables": [
+                {**table, "columns": [column._asdict() for column in table["columns"]]}
+                for table in schema["tables"]
+            ]
+        }
+        
         with open(filename, 'w') as f:
             json.dump(schema, f, indent=2, default=str)
             
         return filename
     
-    def get_formatted_schema_for_prompt(self, include_sample_data=False):
-        """Format schema in a way that's optimized for LLM prompts"""
-        schema = self.extract_full_schema(include_sample_data, sample_data_limit=2)
+    def get_formatted_schema_for_prompt(self, include_sample_data=False, sample_data_limit=2):
+        """
+        Format schema in a way that's optimized for LLM prompts
+        The text only changes with the schema, so it's cached in memory and on disk per schema version
+        """
+        version = get_schema_version(self.connection_string)
+        if version is None:
+            schema = self.extract_full_schema(include_sample_data, sample_data_limit=sample_data_limit)
+            return self._format_schema_for_prompt(schema, include_sample_data)
+        
+        try:
+            # Failed extractions raise, so they are never cached
+            return self._formatted_schema(version, include_sample_data, sample_data_limit)
+        except Exception as e:
+            print(f"Error extracting schema: {e}")
+            return self._format_schema_for_prompt({"tables": [], "relationships": []}, include_sample_data)
+    
+    def _formatted_schema_for_version(self, version, include_sample_data, sample_data_limit):
+        """Load the formatted schema for a schema version from the on-disk cache, or build it"""
+        cache_path = os.path.join(
+            CACHE_DIR,
+            f"prompt-{version}-{PROMPT_FORMAT_VERSION}-{int(include_sample_data)}-{sample_data_limit}.txt"
+        )
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ignoring unreadable prompt schema cache: {e}")
         
-        formatted_schema = []
+        schema = self.extract_full_schema(include_sample_data, sample_data_limit=sample_data_limit, strict=True)
+        formatted_schema = self._format_schema_for_prompt(schema, include_sample_data)
+        
+        try:
+            write_cache_file(cache_path, formatted_schema)
+        except Exception as e:
+            print(f"Error saving prompt schema cache: {e}")
+        
+        return formatted_schema
+    
+    @staticmethod
+    def _format_schema_for_prompt(schema, include_sample_data):
+        buf = io.StringIO()
+        write = buf.write
         
         # Format tables and columns
         for table in schema["tables"]:
-            table_str = f"Table: {table['schema']}.{table['name']}"
+            write(f"Table: {table['schema']}.{table['name']}")
             if table["description"]:
-                table_str += f" - {table['description']}"
-            formatted_schema.append(table_str)
+                write(f" - {table['description']}")
+            write("\n")
             
             # Add columns
             for column in table["columns"]:
-                col_str = f"  - {column['column_name']} ({column['data_type']})"
+                write(f"  - {column.column_name} ({column.data_type})")
                 
                 # Add primary/foreign key indicators
-                indicators = []
-                if column["is_primary_key"]:
-                    indicators.append("PK")
-                if column["is_foreign_key"]:
-                    indicators.append("FK")
-                if indicators:
-                    col_str += f" [{', '.join(indicators)}]"
+                write(KEY_INDICATORS[bool(column.is_primary_key), bool(column.is_foreign_key)])
                 
                 # Add description if available
-                if column["description"]:
-                    col_str += f" - {column['description']}"
-                    
-                formatted_schema.append(col_str)
+                if column.description:
+                    write(f" - {column.description}")
+                write("\n")
             
             # Add sample data if included
             if include_sample_data and "sample_data" in table and table["sample_data"]:
-                formatted_schema.append("  Sample data:")
+                write("  Sample data:\n")
                 for i, row in enumerate(table["sample_data"]):
-                    formatted_schema.append(f"    Row {i+1}: {json.dumps(row, default=str)}")
+                    write(f"    Row {i+1}: {json.dumps(row, default=str)}\n")
             
-            formatted_schema.append("")  # Empty line for readability
+            write("\n")  # Empty line for readability
         
         # Format relationships
-        formatted_schema.append("Relationships:")
+        write("Relationships:")
         for rel in schema["relationships"]:
-            rel_str = (f"  - {rel['parent_schema']}.{rel['parent_table']}.{rel['parent_column']} → "
-                      f"{rel['referenced_schema']}.{rel['referenced_table']}.{rel['referenced_column']}")
-            formatted_schema.append(rel_str)
+            write(f"\n  - {rel['parent_schema']}.{rel['parent_table']}.{rel['parent_column']} → "
+                  f"{rel['referenced_schema']}.{rel['referenced_table']}.{rel['referenced_column']}")
         
-        return "\n".join(formatted_schema)
+        return buf.getvalue()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,7 @@
-import pyodbc
 import json
-import os
 from dotenv import load_dotenv
 import logging
+from db import connect, iter_rows
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -11,31 +10,11 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-def get_connection():
-    """Create and return a connection to the database"""
-    try:
-        connection_string = (
-            f"""
-    DRIVER={{ODBC Driver 17 for SQL Server}};
-    SERVER={os.getenv('DB_SERVER')};
-    DATABASE={os.getenv('DB_NAME')};
-    UID={os.getenv('DB_USER')};
-    PWD={os.getenv('DB_PASSWORD')};
-"""
-        )
-        return pyodbc.connect(connection_string)
-    except Exception as e:
-        logger.error(f"Error connecting to database: {e}")
-        return None
-
 def get_tables():
     """Get a list of tables in the database"""
-    conn = get_connection()
-    if not conn:
-        return []
-    
     tables = []
     try:
+        conn = connect()
         cursor = conn.cursor()
         cursor.execute("""
             SELECT 
@@ -49,7 +28,7 @@ def get_tables():
                 s.name, t.name
         """)
         
-        for row in cursor.fetchall():
+        for row in iter_rows(cursor):
             tables.append({
                 "name": row.table_name,
                 "schema": row.schema_name
@@ -64,12 +43,9 @@ def get_tables():
 
 def get_columns(schema_name, table_name):
     """Get columns for a specific table"""
-    conn = get_connection()
-    if not conn:
-        return []
-    
     columns = []
     try:
+        conn = connect()
         cursor = conn.cursor()
         cursor.execute("""
             SELECT 
@@ -90,7 +66,7 @@ def get_columns(schema_name, table_name):
                 c.column_id
         """, table_name, schema_name)
         
-        for row in cursor.fetchall():
+        for row in iter_rows(cursor):
             columns.append({
                 "name": row.column_name,
                 "type": row.data_type,
@@ -104,9 +80,52 @@ def get_columns(schema_name, table_name):
     
     return columns
 
+def get_all_columns():
+    """
+    Get the columns of every table in a single query
+    Returns a dict mapping (schema_name, table_name) -> list of columns
+    """
+    columns = {}
+    try:
+        conn = connect()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT 
+                s.name AS schema_name,
+                tbl.name AS table_name,
+                c.name AS column_name,
+                t.name AS data_type,
+                c.is_nullable
+            FROM 
+                sys.columns c
+            INNER JOIN 
+                sys.types t ON c.user_type_id = t.user_type_id
+            INNER JOIN 
+                sys.tables tbl ON c.object_id = tbl.object_id
+            INNER JOIN 
+                sys.schemas s ON tbl.schema_id = s.schema_id
+            ORDER BY 
+                s.name, tbl.name, c.column_id
+        """)
+        
+        for row in iter_rows(cursor):
+            columns.setdefault((row.schema_name, row.table_name), []).append({
+                "name": row.column_name,
+                "type": row.data_type,
+                "nullable": row.is_nullable
+            })
+        
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        logger.error(f"Error getting columns: {e}")
+    
+    return columns
+
 def create_formatted_schema():
     """Create formatted schema text for the prompt"""
     tables = get_tables()
+    all_columns = get_all_columns()
     
     formatted_schema = []
     formatted_schema.append("Database Schema:")
@@ -117,8 +136,7 @@ def create_formatted_schema():
         
         formatted_schema.append(f"\nTable: {schema_name}.{table_name}")
         
-        columns = get_columns(schema_name, table_name)
-        for column in columns:
+        for column in all_columns.get((schema_name, table_name), []):
             nullable = "NULL" if column["nullable"] else "NOT NULL"
             formatted_schema.append(f"  - {column['name']} ({column['type']}, {nullable})")
     
@@ -3,46 +3,38 @@ sql_validator.py: Enhanced SQL validation with schema and column validation
 """
 import re
 import logging
+import argparse
+import json
+from functools import lru_cache
 import os
-import pyodbc
-import sqlparse
+import sys
+import threading
+import sqlglot
+from sqlglot import exp
 from dotenv import load_dotenv
+from db import CACHE_DIR, connect, get_schema_version, iter_rows, write_cache_file
 
 # Load environment variables
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    """Create and return a database connection"""
-    try:
-        connection_string = (f"""
-    DRIVER={{ODBC Driver 17 for SQL Server}};
-    SERVER={os.getenv('DB_SERVER')};
-    DATABASE={os.getenv('DB_NAME')};
-    UID={os.getenv('DB_USER')};
-    PWD={os.getenv('DB_PASSWORD')};
-"""
-        )
-        return pyodbc.connect(connection_string)
-    except Exception as e:
-        logger.error(f"Error connecting to database: {e}")
-        return None
+# Bump when the cached data layout changes so stale cache files are ignored
+CACHE_FORMAT_VERSION = 3
 
 def get_database_schemas():
     """Fetch all schemas from the database"""
     schemas = set()
     try:
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA")
+        conn = connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA")
+        
+        for row in iter_rows(cursor):
+            schemas.add(row[0])
             
-            for row in cursor.fetchall():
-                schemas.add(row[0])
-                
-            cursor.close()
-            conn.close()
+        cursor.close()
+        conn.close()
     except Exception as e:
         logger.error(f"Error fetching schemas: {e}")
         # Fall back to default AdventureWorks schemas if we can't fetch them
@@ -53,147 +45,228 @@ def get_database_schemas():
 def get_database_columns():
     """
     Fetch all columns from all tables in the database
-    Returns a dict mapping {schema.table: set(columns)}
+    Returns a dict mapping {schema.table: frozenset(columns)}, with all names lowercased
     """
     columns_dict = {}
     try:
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            query = """
-            SELECT 
-                TABLE_SCHEMA, 
-                TABLE_NAME, 
-                COLUMN_NAME 
-            FROM 
-                INFORMATION_SCHEMA.COLUMNS
-            ORDER BY 
-                TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION
-            """
-            cursor.execute(query)
+        conn = connect()
+        cursor = conn.cursor()
+        query = """
+        SELECT 
+            TABLE_SCHEMA, 
+            TABLE_NAME, 
+            COLUMN_NAME 
+        FROM 
+            INFORMATION_SCHEMA.COLUMNS
+        ORDER BY 
+            TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION
+        """
+        cursor.execute(query)
+        
+        for row in iter_rows(cursor):
+            schema = row[0]
+            table = row[1]
+            column = row[2]
             
-            for row in cursor.fetchall():
-                schema = row[0]
-                table = row[1]
-                column = row[2]
-                
-                table_key = f"{schema}.{table}"
-                
-                if table_key not in columns_dict:
-                    columns_dict[table_key] = set()
-                
-                columns_dict[table_key].add(column)
-                
-            cursor.close()
-            conn.close()
+            table_key = f"{schema}.{table}"
+            
+            if table_key not in columns_dict:
+                columns_dict[table_key] = set()
+            
+            columns_dict[table_key].add(column)
+            
+        cursor.close()
+        conn.close()
     except Exception as e:
         logger.error(f"Error fetching columns: {e}")
     
-    return columns_dict
+    return normalize_columns(columns_dict)
+
+def normalize_columns(columns_dict):
+    """
+    Lowercase and intern table and column names, and freeze the column sets
+    SQL Server identifiers are case-insensitive, so lookups are lowercased to match
+    """
+    return {
+        sys.intern(table.lower()): frozenset(sys.intern(column.lower()) for column in columns)
+        for table, columns in columns_dict.items()
+    }
+
+def _cache_path(version):
+    return os.path.join(CACHE_DIR, f"{version}-{CACHE_FORMAT_VERSION}.json")
+
+def load_schema_metadata(refresh=False):
+    """
+    Return (schema_version, schemas, columns_dict) for the database
+    schema_version is None when it can't be read. Results are memoized in memory and cached on disk per schema version, so unchanged
+    schemas skip the INFORMATION_SCHEMA scans
+    
+    Parameters:
+    - refresh: Whether to drop the cached metadata and query the database
+    """
+    version = get_schema_version()
+    if not version:
+        return None, get_database_schemas(), get_database_columns()
+    
+    if refresh:
+        _schema_metadata_for_version.cache_clear()
+        try:
+            os.remove(_cache_path(version))
+        except FileNotFoundError:
+            pass
+    
+    schemas, columns_dict = _schema_metadata_for_version(version)
+    if not columns_dict:
+        # Don't keep a failed fetch around; retry on the next call
+        _schema_metadata_for_version.cache_clear()
+    return version, schemas, columns_dict
+
+@lru_cache(maxsize=1)
+def _schema_metadata_for_version(version):
+    """Load schema metadata for a schema version from the on-disk cache, or from the database"""
+    try:
+        # JSON rather than pickle, so a writable cache directory can't be used to run code
+        with open(_cache_path(version), encoding="utf-8") as f:
+            cached = json.load(f)
+        schemas = set(cached["schemas"])
+        columns_dict = normalize_columns(cached["columns"])
+        logger.info(f"Loaded schema metadata from cache (version {version})")
+        return schemas, columns_dict
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable schema cache: {e}")
+    
+    schemas = get_database_schemas()
+    columns_dict = get_database_columns()
+    
+    # Only cache complete results; an empty column dict means the database couldn't be read
+    if columns_dict:
+        try:
+            write_cache_file(_cache_path(version), json.dumps({
+                "schemas": sorted(schemas),
+                "columns": {table: sorted(columns) for table, columns in columns_dict.items()}
+            }))
+        except Exception as e:
+            logger.warning(f"Error saving schema cache: {e}")
+    
+    return schemas, columns_dict
+
+# Dangerous operations that should be caught, as (name, pattern, message)
+DANGEROUS_PATTERNS = [
+    ('DROP', r'\bDROP\b', 'DROP operations are not allowed'),
+    ('TRUNCATE', r'\bTRUNCATE\b', 'TRUNCATE operations are not allowed'),
+    ('DELETE', r'\bDELETE\b', 'DELETE operations are not allowed'),
+    ('UPDATE', r'\bUPDATE\b', 'UPDATE operations are not allowed'),
+    ('INSERT', r'\bINSERT\b', 'INSERT operations are not allowed'),
+    ('EXEC', r'\bEXEC\b|\bEXECUTE\b', 'EXEC/EXECUTE operations are not allowed'),
+    ('MASTER', r'\bMASTER\b', 'References to master database are not allowed'),
+    ('SYSDBA', r'\bSYSDBA\b', 'SYSDBA operations are not allowed'),
+    ('OUTFILE', r'\bINTO\s+OUTFILE\b', 'INTO OUTFILE operations are not allowed'),
+    ('LOAD_FILE', r'\bLOAD_FILE\b', 'LOAD_FILE operations are not allowed'),
+    ('ALTER', r'\bALTER\b', 'ALTER operations are not allowed'),
+    ('CREATE', r'\bCREATE\b', 'CREATE operations are not allowed'),
+    ('LINE_COMMENT', r'--', 'SQL comments are not allowed'),
+    ('BLOCK_COMMENT', r'/\*', 'SQL comments are not allowed'),
+]
+
+# All dangerous patterns fused into one alternation, so a single scan finds the first violation;
+# the name of the group that matched identifies its message
+DANGEROUS_RE = re.compile(
+    '|'.join(f'(?P<{name}>{pattern})' for name, pattern, _ in DANGEROUS_PATTERNS),
+    re.IGNORECASE
+)
+DANGEROUS_MESSAGES = {name: message for name, _, message in DANGEROUS_PATTERNS}
+
+# Better check for multiple statements that's less likely to give false positives
+MULTIPLE_STATEMENTS_RE = re.compile(r';\s*(SELECT|INSERT|UPDATE|DELETE|DROP|CREATE|ALTER)\b', re.IGNORECASE)
+
+# Allowed SQL operation patterns - only SELECT as per your requirement
+ALLOWED_OPERATIONS = [
+    re.compile(r'\bSELECT\b', re.IGNORECASE),
+]
+
+# Format: (FROM|JOIN) schema.
+SCHEMA_REF_RE = re.compile(r'\b(?:FROM|JOIN)\s+([a-zA-Z0-9_]+)\.', re.IGNORECASE)
+
+# Warning patterns
+SLOW_LIKE_RE = re.compile(r'\bLIKE\s+[\'"]%', re.IGNORECASE)
+OR_RE = re.compile(r'\bOR\b', re.IGNORECASE)
+ORDER_BY_RE = re.compile(r'ORDER BY', re.IGNORECASE)
+ROW_LIMIT_RE = re.compile(r'TOP|OFFSET|FETCH', re.IGNORECASE)
+
+SELECT_RE = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
 
 class SqlValidator:
-    def __init__(self, schemas=None, columns_dict=None):
-        # Dangerous operations that should be caught
-        self.dangerous_patterns = [
-            (r'\bDROP\b', 'DROP operations are not allowed'),
-            (r'\bTRUNCATE\b', 'TRUNCATE operations are not allowed'),
-            (r'\bDELETE\b', 'DELETE operations are not allowed'),
-            (r'\bUPDATE\b', 'UPDATE operations are not allowed'),
-            (r'\bINSERT\b', 'INSERT operations are not allowed'),
-            (r'\bEXEC\b|\bEXECUTE\b', 'EXEC/EXECUTE operations are not allowed'),
-            (r'\bMASTER\b', 'References to master database are not allowed'),
-            (r'\bSYSDBA\b', 'SYSDBA operations are not allowed'),
-            (r'\bINTO\s+OUTFILE\b', 'INTO OUTFILE operations are not allowed'),
-            (r'\bLOAD_FILE\b', 'LOAD_FILE operations are not allowed'),
-            (r'\bALTER\b', 'ALTER operations are not allowed'),
-            (r'\bCREATE\b', 'CREATE operations are not allowed'),
-            (r'--', 'SQL comments are not allowed'),
-            (r'/\*', 'SQL comments are not allowed'),
-        ]
+    def __init__(self, schemas=None, columns_dict=None, refresh=False):
+        # Patterns are compiled once at import time and shared by all validators
+        self.dangerous_pattern = DANGEROUS_RE
+        self.multiple_statements_pattern = MULTIPLE_STATEMENTS_RE
+        self.allowed_operations = ALLOWED_OPERATIONS
         
-        # Better check for multiple statements that's less likely to give false positives
-        self.multiple_statements_pattern = r';\s*(SELECT|INSERT|UPDATE|DELETE|DROP|CREATE|ALTER)\b'
-        
-        # Allowed SQL operation patterns - only SELECT as per your requirement
-        self.allowed_operations = [
-            r'\bSELECT\b',
-        ]
+        # Fetch whatever wasn't provided from the database (or its on-disk cache)
+        # schema_version identifies the metadata in use; it's None for caller-provided data
+        self.schema_version = None
+        if not schemas or not columns_dict:
+            self.schema_version, db_schemas, db_columns = load_schema_metadata(refresh=refresh)
         
         # Set schemas - either provided or fetch from database
-        self.valid_schemas = schemas if schemas else get_database_schemas()
+        # Schema names are case-insensitive, so they're compared lowercased
+        schemas = schemas if schemas else db_schemas
+        self.valid_schemas = frozenset(schema.lower() for schema in schemas)
+        self.valid_schemas_display = ', '.join(sorted(schemas))
         
         # Set columns dictionary - either provided or fetch from database
-        self.columns_dict = columns_dict if columns_dict else get_database_columns()
+        self.columns_dict = normalize_columns(columns_dict) if columns_dict else db_columns
         
         logger.info(f"Validator initialized with {len(self.valid_schemas)} schemas and {len(self.columns_dict)} tables")
     
-    def extract_table_aliases(self, sql):
+    def extract_table_aliases(self, tree):
         """
-        Extract table aliases from SQL query
+        Extract table aliases from a parsed SQL query
         Returns dict mapping alias -> full table name (with schema)
         """
         aliases = {}
         
-        # Parse the SQL
-        parsed = sqlparse.parse(sql)
-        if not parsed:
-            return aliases
-        
-        stmt = parsed[0]
-        
-        # Simple regex pattern to find table references with aliases
-        # This is a simplified approach and may not catch all cases
-        # Format: (FROM|JOIN) schema.table [AS] alias
-        table_pattern = r'(?:FROM|JOIN)\s+([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)(?:\s+(?:AS\s+)?([a-zA-Z0-9_]+))?'
-        
-        matches = re.finditer(table_pattern, sql, re.IGNORECASE)
-        for match in matches:
-            schema = match.group(1)
-            table = match.group(2)
-            alias = match.group(3)
+        # Only schema-qualified tables can be checked against the columns dictionary;
+        # CTE and unqualified references are left alone
+        for table in tree.find_all(exp.Table):
+            if not table.db:
+                continue
             
-            full_name = f"{schema}.{table}"
-            
-            if alias:
-                aliases[alias.lower()] = full_name
-            else:
-                # If no alias is specified, the table name itself serves as an implicit alias
-                aliases[table.lower()] = full_name
+            # If no alias is specified, the table name itself serves as an implicit alias
+            aliases[table.alias_or_name.lower()] = f"{table.db}.{table.name}"
         
         return aliases
     
-    def extract_column_references(self, sql):
+    def extract_column_references(self, tree):
         """
-        Extract column references from SQL query
+        Extract column references from a parsed SQL query
         Returns a list of (table_alias, column_name) tuples
         """
         column_refs = []
         
-        # This is a simplified approach and may not catch all cases
-        # Pattern to find column references: table_alias.column_name
-        column_pattern = r'([a-zA-Z0-9_]+)\.([a-zA-Z0-9_]+)'
-        
-        matches = re.finditer(column_pattern, sql, re.IGNORECASE)
-        for match in matches:
-            table_alias = match.group(1).lower()
-            column_name = match.group(2)
-            column_refs.append((table_alias, column_name))
+        for column in tree.find_all(exp.Column):
+            # Only qualified references (alias.column) can be resolved; skip alias.*
+            if not column.table or isinstance(column.this, exp.Star):
+                continue
+            column_refs.append((column.table.lower(), column.name))
         
         return column_refs
     
-    def validate_columns(self, sql):
+    def validate_columns(self, tree):
         """
-        Validate that all columns referenced in the query exist in their respective tables
+        Validate that all columns referenced in the parsed query exist in their respective tables
         Returns (is_valid, error_message)
         """
         try:
             # Extract table aliases
-            aliases = self.extract_table_aliases(sql)
+            aliases = self.extract_table_aliases(tree)
             if not aliases:
                 return True, ""  # Skip validation if we couldn't extract any tables
             
             # Extract column references
-            column_refs = self.extract_column_references(sql)
+            column_refs = self.extract_column_references(tree)
             
             for table_alias, column_name in column_refs:
                 # Skip validation for columns that aren't using table aliases
@@ -203,11 +276,12 @@ class SqlValidator:
                 full_table_name = aliases[table_alias]
                 
                 # Check if the table exists in our columns dictionary
-                if full_table_name not in self.columns_dict:
+                table_columns = self.columns_dict.get(full_table_name.lower())
+                if table_columns is None:
                     return False, f"Referenced table not found: {full_table_name}"
                 
                 # Check if the column exists in the table
-                if column_name not in self.columns_dict[full_table_name]:
+                if column_name.lower() not in table_columns:
                     return False, f"Column '{column_name}' not found in table '{full_table_name}'"
             
             return True, ""
@@ -229,7 +303,7 @@ class SqlValidator:
         # Check for allowed operations
         operation_found = False
         for pattern in self.allowed_operations:
-            if re.search(pattern, sql, re.IGNORECASE):
+            if pattern.search(sql):
                 operation_found = True
                 break
                 
@@ -237,27 +311,35 @@ class SqlValidator:
             return False, "Only SELECT operations are allowed"
         
         # Check for dangerous patterns
-        for pattern, message in self.dangerous_patterns:
-            if re.search(pattern, sql, re.IGNORECASE):
-                return False, message
+        match = self.dangerous_pattern.search(sql)
+        if match:
+            return False, DANGEROUS_MESSAGES[match.lastgroup]
         
         # Check for multiple statements with a better pattern
-        if re.search(self.multiple_statements_pattern, sql, re.IGNORECASE):
+        if self.multiple_statements_pattern.search(sql):
             return False, "Multiple SQL statements are not allowed"
         
         # Validate schema references
-        schemas_used = set(re.findall(r'FROM\s+([a-zA-Z0-9_]+)\.', sql))
-        schemas_used.update(re.findall(r'JOIN\s+([a-zA-Z0-9_]+)\.', sql))
+        schemas_used = set(SCHEMA_REF_RE.findall(sql))
         
         for schema in schemas_used:
-            if schema not in self.valid_schemas:
-                return False, f"Invalid schema: {schema}. Valid schemas are: {', '.join(self.valid_schemas)}"
+            if schema.lower() not in self.valid_schemas:
+                return False, f"Invalid schema: {schema}. Valid schemas are: {self.valid_schemas_display}"
         
         # Validate columns if there are schema references
         if schemas_used:
-            is_valid, error = self.validate_columns(sql)
-            if not is_valid:
-                return False, error
+            # Parse once; the alias and column walks share the tree
+            try:
+                tree = sqlglot.parse_one(sql, read="tsql")
+            except sqlglot.errors.SqlglotError as e:
+                # Covers tokenizer errors (e.g. an unterminated literal) as well as parse errors
+                logger.warning(f"Could not parse SQL, skipping column validation: {e}")
+                tree = None
+            
+            if tree is not None:
+                is_valid, error = self.validate_columns(tree)
+                if not is_valid:
+                    return False, error
         
         # All checks passed
         return True, ""
@@ -270,12 +352,11 @@ class SqlValidator:
         warnings = []
         
         # Check for potentially slow queries
-        if (re.search(r'\bLIKE\s+[\'"]%', sql, re.IGNORECASE) or 
-            re.search(r'\bOR\b', sql, re.IGNORECASE)):
+        if SLOW_LIKE_RE.search(sql) or OR_RE.search(sql):
             warnings.append("This query may be slow due to LIKE '%...' pattern or OR conditions")
         
         # Check for missing indexes (simplified example)
-        if re.search(r'ORDER BY', sql, re.IGNORECASE) and not re.search(r'TOP|OFFSET|FETCH', sql, re.IGNORECASE):
+        if ORDER_BY_RE.search(sql) and not ROW_LIMIT_RE.search(sql):
             warnings.append("This query uses ORDER BY without LIMIT which may be inefficient")
         
         # Check for semicolons - now just a warning
@@ -286,6 +367,8 @@ class SqlValidator:
 
 # Create validator instance - will be reused by get_sql_analysis
 _validator = None
+# Serializes validator construction so concurrent requests don't each scan the database
+_validator_lock = threading.Lock()
 
 def get_sql_analysis(sql, refresh=False):
     """
@@ -298,35 +381,67 @@ def get_sql_analysis(sql, refresh=False):
     """
     global _validator
     
-    # Create or refresh the validator if needed
+    # Create or refresh the validator if needed, checking again once the lock is held
     if _validator is None or refresh:
-        _validator = SqlValidator()
+        with _validator_lock:
+            if _validator is None or refresh:
+                _validator = SqlValidator(refresh=refresh)
+                _analyze.cache_clear()
     
-    is_valid, error = _validator.validate(sql)
-    warnings = _validator.check_for_warnings(sql) if is_valid else []
+    is_valid, error, warnings = _analyze(normalize_sql(sql), _validator.schema_version)
     
     return {
         "is_valid": is_valid,
         "error": error,
-        "warnings": warnings,
+        "warnings": list(warnings),
         "estimated_safe": is_valid and not warnings
     }
 
+def normalize_sql(sql):
+    """
+    Collapse whitespace so formatting-only differences share an analysis cache entry
+    Comments and case are left alone: the validator rejects comments, and case is
+    significant inside string literals, so folding either could change the result
+    """
+    return " ".join(sql.split())
+
+@lru_cache(maxsize=4096)
+def _analyze(sql, schema_version):
+    """
+    Validate normalized SQL with the current validator, memoized per (SQL, schema version)
+    The cache is also cleared whenever the validator is replaced, since caller-provided
+    or fallback metadata has no version
+    """
+    is_valid, error = _validator.validate(sql)
+    warnings = tuple(_validator.check_for_warnings(sql)) if is_valid else ()
+    return is_valid, error, warnings
+
 def is_select_statement(sql):
     """Check if the SQL is a SELECT statement only"""
-    select_pattern = r'^\s*SELECT\b'
-    return bool(re.match(select_pattern, sql, re.IGNORECASE))
+    return bool(SELECT_RE.match(sql))
 
-def refresh_schemas_and_columns():
-    """Force refresh of schema and column information"""
+def refresh_schemas_and_columns(refresh=False):
+    """
+    Reload schema and column information
+    Uses the on-disk cache while the database schema is unchanged, unless refresh is set
+    """
     global _validator
-    _validator = SqlValidator()
+    with _validator_lock:
+        _validator = SqlValidator(refresh=refresh)
+        _analyze.cache_clear()
     return {
         "schemas": list(_validator.valid_schemas),
         "tables": list(_validator.columns_dict.keys())
     }
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test the SQL validator")
+    parser.add_argument("--refresh", action="store_true", help="ignore the on-disk schema cache")
+    args = parser.parse_args()
+    
+    if args.refresh:
+        refresh_schemas_and_columns(refresh=True)
+    
     # Test the validator
     test_queries = [
         "SELECT * FROM Person.Person",
@@ -334,6 +449,7 @@ if __name__ == "__main__":
         "SELECT p.FirstName, p.LastName, e.HireDate FROM Person.Person p JOIN HumanResources.Employee e ON p.BusinessEntityID = e.BusinessEntityID",
         "SELECT p.NonExistentColumn FROM Person.Person p",
         "SELECT * FROM NonExistentSchema.Table",
+        "SELECT 'abc FROM Person.Person",
     ]
     
     print(f"Using schemas: {get_database_schemas()}")